@@ -1,47 +1,52 @@
-import json
-import pprint
+import concurrent.futures
 import signal
 import sys
-import xml.etree.ElementTree as ET
-from dataclasses import dataclass, asdict
-from typing import Dict, List, Optional
+import zlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 import carla
-import traci
+import numpy as np
+import traci.constants as tc
+from coords import affine_params, read_boundaries_from_net, sumo_to_carla_batch
+from traci_backend import LIBSUMO, traci
+
+# orjson быстрее разбирает JSON, но необязателен
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 
 # -------------------- Config --------------------
 # Блок нужен для проверки файла конфигурации, чтобы в нем были все значения
+# Конфиг после загрузки не меняется; __slots__ задан вручную, т.к. dataclass(slots=True) есть только с Python 3.10
 
-@dataclass
+@dataclass(frozen=True)
 class SumoConfig:
+    __slots__ = ("config_file", "net_file", "step_length")
     config_file: str
     net_file: str
     step_length: float
 
-@dataclass
+@dataclass(frozen=True)
 class CarlaWorldConfig:
+    __slots__ = ("name", "host", "port")
     name: str
     host: str
     port: int
 
-@dataclass
+@dataclass(frozen=True)
 class ZoneConfig:
+    __slots__ = ("axis", "start", "end", "z_offset")
     axis: str
     start: float
     end: float
     z_offset: float
 
-@dataclass
-class Boundary:
-    minX: float
-    minY: float
-    maxX: float
-    maxY: float
-
 class Config:
     def __init__(self, path: str):
-        with open(path, "r") as f:
-            data = json.load(f)
+        with open(path, "rb") as f:
+            data = _json.loads(f.read())
 
         # SUMO
         self.sumo = SumoConfig(
@@ -69,8 +74,13 @@ class Config:
             z_offset=float(z.get("z_offset", 0.1))
         )
 
+        # Отформатированный конфиг для вывода, считается при первом вызове print
+        self._dump: Optional[str] = None
+
     # Logs
+    # pprint и asdict нужны только для вывода конфига, поэтому импортируются здесь, а не при запуске
     def to_dict(self):
+        from dataclasses import asdict
         return {
             "sumo": asdict(self.sumo),
             "carla": [asdict(w) for w in self.carla_worlds],
@@ -78,37 +88,24 @@ class Config:
         }
 
     def print(self):
-        pprint.pprint(self.to_dict())
-
-
-# -------------------- Coord transform --------------------
-# Блок нужен для трансформации координат net.xml и xodr
-# В файле net.xml есть тег location, в котором указаны границы карты и их смещение
-# Bз этого можно в реальном времени перевести координаты машины в SUMO в координаты Carla карты 
+        if self._dump is None:
+            import pprint
+            self._dump = pprint.pformat(self.to_dict())
+        print(self._dump)
 
-def read_boundaries_from_net(net_file: str):
-    tree = ET.parse(net_file)
-    root = tree.getroot()
-    location = root.find("location")
-    if location is None:
-        raise ValueError("No <location> found in net.xml")
 
-    conv_vals = list(map(float, location.get("convBoundary").split(",")))
-    orig_vals = list(map(float, location.get("origBoundary").split(",")))
-
-    conv = Boundary(*conv_vals)
-    orig = Boundary(*orig_vals)
-    return conv, orig
+# -------------------- Bridge --------------------
 
-def create_coordinate_transformer(conv: Boundary, orig: Boundary):
-    def transform(convX: float, convY: float):
-        x = orig.minX + ((convX - conv.minX) / (conv.maxX - conv.minX)) * (orig.maxX - orig.minX)
-        y = orig.minY + ((convY - conv.minY) / (conv.maxY - conv.minY)) * (orig.maxY - orig.minY)
-        return x, y
-    return transform
+# Порог изменения позы (метры и градусы), ниже которого трансформ актеру не отправляется
+POSE_EPS = 0.01
+YAW_EPS = 0.1
 
+# Подъем по Z при повторном спавне: на z_offset спавн бывает неудачным из-за коллизии с дорогой
+SPAWN_LIFT = 0.5
 
-# -------------------- Bridge --------------------
+# Флаги миров, в которых должна быть машина
+FLAG_A = 1
+FLAG_B = 2
 
 class Bridge:
     def __init__(self, cfg: Config):
@@ -124,46 +121,75 @@ class Bridge:
         self.world_b = self.client_b.get_world()
 
         # Save settings
-        self._orig_settings_a = self.world_a.get_settings()
-        self._orig_settings_b = self.world_b.get_settings()
+        # Настройки запрашиваются один раз, дальше меняется и применяется этот же объект
+        self._settings_a = self.world_a.get_settings()
+        self._settings_b = self.world_b.get_settings()
+        self._orig_sync_a = (self._settings_a.synchronous_mode, self._settings_a.fixed_delta_seconds)
+        self._orig_sync_b = (self._settings_b.synchronous_mode, self._settings_b.fixed_delta_seconds)
 
         # Sync
-        self._apply_sync(self.world_a, self.cfg.sumo.step_length)
-        self._apply_sync(self.world_b, self.cfg.sumo.step_length)
+        self._apply_sync(self.world_a, self._settings_a, True, self.cfg.sumo.step_length)
+        self._apply_sync(self.world_b, self._settings_b, True, self.cfg.sumo.step_length)
 
         # Blueprints
-        self.bps_a = self.world_a.get_blueprint_library().filter("vehicle.*")
-        self.bps_b = self.world_b.get_blueprint_library().filter("vehicle.*")
-
-        # Actors registry
-        self.actors: Dict[str, Dict[str, Optional[carla.Actor]]] = {}
-        self._last_ids: set[str] = set()
+        # Обычный список, чтобы не обращаться к BlueprintLibrary при каждом спавне, и только с role_name
+        self.bps_a = [bp for bp in self.world_a.get_blueprint_library().filter("vehicle.*") if bp.has_attribute("role_name")]
+        self.bps_b = [bp for bp in self.world_b.get_blueprint_library().filter("vehicle.*") if bp.has_attribute("role_name")]
+
+        # Actors registry: id машины -> id актера в мире A и в мире B
+        # Хранятся id актеров, все операции с ними идут пакетными командами
+        self._a: Dict[str, int] = {}
+        self._b: Dict[str, int] = {}
+        # Актеры машин, исчезнувших из SUMO, удаляются вместе с остальными командами шага
+        self._pending_destroy_a: List[int] = []
+        self._pending_destroy_b: List[int] = []
+        # Машины в SUMO, обновляется по спискам появившихся и завершивших маршрут машин
+        self._active_ids: set[str] = set()
+        # Стабильный хеш id машины для выбора blueprint, одинаковый между запусками и мирами
+        self._bp_idx: Dict[str, int] = {}
+        # Последняя отправленная в CARLA поза (x, y, yaw) каждой машины
+        self._last_pose: Dict[str, Tuple[float, float, float]] = {}
+        # Машины, спавн которых в мире не удался: следующий спавн идет с подъемом по Z
+        self._spawn_failed_a: set[str] = set()
+        self._spawn_failed_b: set[str] = set()
+        # Машины, заспавненные с подъемом: на следующем шаге им принудительно отправляется трансформ
+        self._lifted_a: set[str] = set()
+        self._lifted_b: set[str] = set()
+
+        # Определение целевого мира
+        self._assign_worlds = self._make_assigner()
+
+        # Миры A и B независимы, поэтому их запросы (пакеты команд и tick) идут параллельно
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
         # Prepare coordinate transformer
         conv, orig = read_boundaries_from_net(self.cfg.sumo.net_file)
-        self.transform = create_coordinate_transformer(conv, orig)
+        self._affine = affine_params(conv, orig)
 
-    # Настраивает CARLA в синхронный режим с фиксированным шагом симуляции
-    def _apply_sync(self, world: carla.World, dt: float):
-        s = world.get_settings()
-        s.synchronous_mode = True
+    # Настраивает режим синхронизации CARLA и шаг симуляции
+    def _apply_sync(self, world: carla.World, s: carla.WorldSettings, sync: bool, dt: Optional[float]):
+        s.synchronous_mode = sync
         s.fixed_delta_seconds = dt
         world.apply_settings(s)
 
-    # Удаление актера без ошибки
-    def _safe_destroy(self, actor: carla.Actor):
-        try:
-            actor.destroy()
-        except Exception:
-            pass
+    # Команды удаления актеров из очереди, очередь при этом очищается
+    def _take_pending_destroy(self, pending: List[int]) -> list:
+        cmds = [carla.command.DestroyActor(i) for i in pending]
+        pending.clear()
+        return cmds
 
-    # Удаляет актёра с указанным ID из обоих миров
+    # Ставит актёров машины с указанным ID в очередь на удаление из обоих миров
     def _destroy_vehicle_everywhere(self, vid: str):
-        if vid in self.actors:
-            for key in ("A", "B"):
-                if self.actors[vid].get(key):
-                    self._safe_destroy(self.actors[vid][key])
-            self.actors.pop(vid, None)
+        self._bp_idx.pop(vid, None)
+        self._last_pose.pop(vid, None)
+        for state in (self._spawn_failed_a, self._spawn_failed_b, self._lifted_a, self._lifted_b):
+            state.discard(vid)
+        actor_a = self._a.pop(vid, None)
+        if actor_a is not None:
+            self._pending_destroy_a.append(actor_a)
+        actor_b = self._b.pop(vid, None)
+        if actor_b is not None:
+            self._pending_destroy_b.append(actor_b)
 
     # Запуск SUMO
     def start_sumo(self):
@@ -175,113 +201,221 @@ class Bridge:
         ])
         print("[bridge] SUMO started")
 
-    # net.xml в xodr
-    def sumo_to_carla_transform(self, xs, ys, angle, z):
-        x, y = self.transform(xs, ys)
-
-        y = -y
-        yaw = angle - 90
-        return carla.Transform(
-            carla.Location(x=x, y=y, z=z),
-            carla.Rotation(pitch=0.0, yaw=yaw, roll=0.0)
+    # net.xml в xodr, считается сразу для массивов координат всех машин
+    # Вход и выход - массивы (N, 3): (x, y, angle) в SUMO и (x, y, yaw) в CARLA
+    def sumo_to_carla(self, arr: np.ndarray) -> np.ndarray:
+        out = np.empty_like(arr)
+        sumo_to_carla_batch(arr[:, 0], arr[:, 1], arr[:, 2], *self._affine, out)
+        return out
+
+    # Команда создания актера
+    # Если спавн не удался (например, из-за коллизии), то машина останется без актера и попытка повторится на следующем шаге
+    # Физика выключается: позицию задает только SUMO, и стоящая машина без трансформа остается на месте
+    # После неудачного спавна машина спавнится выше на SPAWN_LIFT, на следующем шаге ее опускает трансформ
+    def _spawn(self, bps, vid: str, tf: carla.Transform, lift: bool) -> carla.command.SpawnActor:
+        idx = self._bp_idx.get(vid)
+        if idx is None:
+            idx = zlib.crc32(vid.encode())
+            self._bp_idx[vid] = idx
+        bp = bps[idx % len(bps)]
+        bp.set_attribute("role_name", vid)
+        if lift:
+            loc = tf.location
+            tf = carla.Transform(carla.Location(x=loc.x, y=loc.y, z=loc.z + SPAWN_LIFT), tf.rotation)
+        return carla.command.SpawnActor(bp, tf).then(
+            carla.command.SetSimulatePhysics(carla.command.FutureActor, False)
         )
 
-    # Создание актера
-    def _spawn(self, world: carla.World, bps, vid: str, tf: carla.Transform) -> Optional[carla.Actor]:
-        idx = abs(hash(vid)) % len(bps)
-        bp = bps[idx]
-        if bp.has_attribute("role_name"):
-            bp.set_attribute("role_name", vid)
-
-        try:
-            actor = world.try_spawn_actor(bp, tf)
-            if actor is None:
-                # Это возможно костыль - увеление координаты по Z, потому что были проблемы при спавне в какой-то момент
-                tf.location.z += 0.5
-                actor = world.try_spawn_actor(bp, tf)
-            return actor
-        except Exception as e:
-            print(f"[spawn] failed for {vid}: {e}")
-            return None
+    # Отправка всех команд мира и tick одним запросом, id созданных актеров записываются в реестр
+    # spawned - номер команды спавна -> id машины; ошибки команд берутся из ответов, без исключений
+    # failed и lifted - состояние повторного спавна этого мира, об ошибке спавна машины пишется только первый раз
+    def _apply_batch(self, client: carla.Client, cmds: list, spawned: Dict[int, str], actors: Dict[str, int],
+                     failed: set, lifted: set, do_tick: bool = True):
+        responses = client.apply_batch_sync(cmds, do_tick)
+        for i, response in enumerate(responses):
+            vid = spawned.get(i)
+            if response.has_error():
+                if vid is None:
+                    print(f"[batch] command failed: {response.error}")
+                elif vid not in failed:
+                    print(f"[spawn] failed for {vid}: {response.error}")
+                    failed.add(vid)
+            elif vid is not None:
+                actors[vid] = response.actor_id
+                # Спавн после неудачи был с подъемом
+                if vid in failed:
+                    failed.discard(vid)
+                    lifted.add(vid)
 
     # определение целевого мира
-    def _assign_worlds(self, x: float, y: float):
+    # Ось и границы зоны фиксируются один раз, функция сразу классифицирует массив координат всех машин:
+    # до начала зоны машина только в A (FLAG_A), после конца только в B (FLAG_B), внутри зоны в обоих мирах
+    def _make_assigner(self):
+        start = self.cfg.zone.start
+        end = self.cfg.zone.end
+
         if self.cfg.zone.axis == "x":
-            if x < self.cfg.zone.start:
-                return {"A"}
-            elif x > self.cfg.zone.end:
-                return {"B"}
-            else:
-                return {"A", "B"}
-        
+            def assign(xs: np.ndarray, ys: np.ndarray):
+                return (xs <= end) * FLAG_A | (xs >= start) * FLAG_B
+
         # На данный момент заглушка, так как еще не внедрил обработку по оси Y
         else:
-            if y < self.cfg.zone.start:
-                return {"A"}
-            elif y > self.cfg.zone.end:
-                return {"B"}
-            else:
-                return {"A", "B"}
+            def assign(xs: np.ndarray, ys: np.ndarray):
+                return (ys <= end) * FLAG_A | (ys >= start) * FLAG_B
+        return assign
 
     # Обработка симуляции
     def run(self):
         self.start_sumo()
+        # За шаг приходят только изменения состава машин, а не полный список
+        traci.simulation.subscribe((tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS))
+
+        # Шаг симуляции
+        traci.simulationStep()
 
         while True:
-            # Шаг симуляции
-            traci.simulationStep()
-            ids = set(traci.vehicle.getIDList())
+            res = traci.simulation.getSubscriptionResults()
+            arrived = res[tc.VAR_ARRIVED_VEHICLES_IDS]
+
+            # Подписка на позицию и угол новых машин, чтобы получать их одним запросом за шаг
+            # Машина могла появиться и завершить маршрут за один шаг, такую пропускаем
+            # id интернируется, чтобы поиск по словарям реестра сравнивал строки по ссылке
+            for vid in res[tc.VAR_DEPARTED_VEHICLES_IDS]:
+                if vid in arrived:
+                    continue
+                vid = sys.intern(vid)
+                self._active_ids.add(vid)
+                traci.vehicle.subscribe(vid, (tc.VAR_POSITION, tc.VAR_ANGLE))
 
             # Если машина исчезла из SUMO, то удаляем и из Carla
-            for gone in list(self._last_ids - ids):
-                self._destroy_vehicle_everywhere(gone)
+            for vid in arrived:
+                self._active_ids.discard(vid)
+                self._destroy_vehicle_everywhere(vid)
+
+            sub = traci.vehicle.getAllSubscriptionResults()
+
+            # Координаты всех машин переводятся одной векторной операцией
+            # float32 - та же точность, что у carla.Location/Rotation, и вдвое меньше данных
+            vids = list(self._active_ids)
+            arr = np.fromiter(
+                (v for vid in vids for v in (*sub[vid][tc.VAR_POSITION], sub[vid][tc.VAR_ANGLE])),
+                dtype=np.float32, count=3 * len(vids)
+            ).reshape(-1, 3)
+
+            # Во время телепортации SUMO отдает INVALID_DOUBLE_VALUE вместо позиции
+            # Такие машины убираем из CARLA, после возвращения на дорогу они заспавнятся заново
+            valid = arr[:, 0] != tc.INVALID_DOUBLE_VALUE
+            if not valid.all():
+                for vid, ok in zip(vids, valid.tolist()):
+                    if not ok:
+                        self._destroy_vehicle_everywhere(vid)
+                vids = [vid for vid, ok in zip(vids, valid.tolist()) if ok]
+                arr = arr[valid]
+
+            # Команды для миров A и B копятся за шаг и отправляются пакетом, первыми идут удаления
+            cmds_a = self._take_pending_destroy(self._pending_destroy_a)
+            cmds_b = self._take_pending_destroy(self._pending_destroy_b)
+            spawned_a: Dict[int, str] = {}
+            spawned_b: Dict[int, str] = {}
+
+            poses = self.sumo_to_carla(arr)
+            xs, ys, yaws = poses[:, 0], poses[:, 1], poses[:, 2]
+            needed = self._assign_worlds(xs, ys)
+            # Снова костыль с осью Z, нужно потестить без него
+            z = self.cfg.zone.z_offset
+
+            # Трансформ строится только для спавна или движения, стоящей машине с актерами он не нужен
+            def make_tf(x: float, y: float, yaw: float) -> carla.Transform:
+                return carla.Transform(
+                    carla.Location(x=x, y=y, z=z),
+                    carla.Rotation(pitch=0.0, yaw=yaw, roll=0.0)
+                )
 
             # Обновление машин и их координат
-            for vid in ids:
-                xs, ys = traci.vehicle.getPosition(vid)
-                angle = traci.vehicle.getAngle(vid)
-                # Снова костыль с осью Z, нужно потестить без него
-                z = self.cfg.zone.z_offset
-
-                tf = self.sumo_to_carla_transform(xs, ys, angle, z)
-                worlds_needed = self._assign_worlds(tf.location.x, tf.location.y)
-
-                state = self.actors.get(vid, {"A": None, "B": None})
-
-                # Если машина должна быть в зоне - спавним
-                if "A" in worlds_needed and state["A"] is None:
-                    state["A"] = self._spawn(self.world_a, self.bps_a, vid, tf)
-                if "B" in worlds_needed and state["B"] is None:
-                    state["B"] = self._spawn(self.world_b, self.bps_b, vid, tf)
-
-                # Если машина не должна быть в зоне - удаляем
-                if "A" not in worlds_needed and state["A"]:
-                    self._safe_destroy(state["A"]); state["A"] = None
-                if "B" not in worlds_needed and state["B"]:
-                    self._safe_destroy(state["B"]); state["B"] = None
-
-                if state["A"]: state["A"].set_transform(tf)
-                if state["B"]: state["B"].set_transform(tf)
-
-                self.actors[vid] = state
-
-            self.world_a.tick()
-            self.world_b.tick()
-            self._last_ids = ids
+            for vid, x, y, yaw, worlds in zip(vids, xs.tolist(), ys.tolist(), yaws.tolist(), needed.tolist()):
+                tf = None
+
+                # Стоящим машинам (например, на светофоре) трансформ не отправляем
+                last = self._last_pose.get(vid)
+                moved = (
+                    last is None
+                    or (x - last[0]) ** 2 + (y - last[1]) ** 2 >= POSE_EPS ** 2
+                    or abs(yaw - last[2]) >= YAW_EPS
+                )
+                if moved:
+                    self._last_pose[vid] = (x, y, yaw)
+
+                # Если машина должна быть в зоне - спавним или двигаем, если не должна - удаляем
+                actor_a = self._a.get(vid)
+                if worlds & FLAG_A:
+                    if actor_a is None:
+                        spawned_a[len(cmds_a)] = vid
+                        tf = tf or make_tf(x, y, yaw)
+                        cmds_a.append(self._spawn(self.bps_a, vid, tf, vid in self._spawn_failed_a))
+                    elif moved or vid in self._lifted_a:
+                        self._lifted_a.discard(vid)
+                        tf = tf or make_tf(x, y, yaw)
+                        cmds_a.append(carla.command.ApplyTransform(actor_a, tf))
+                elif actor_a is not None:
+                    cmds_a.append(carla.command.DestroyActor(actor_a)); del self._a[vid]
+                    self._lifted_a.discard(vid)
+
+                actor_b = self._b.get(vid)
+                if worlds & FLAG_B:
+                    if actor_b is None:
+                        spawned_b[len(cmds_b)] = vid
+                        tf = tf or make_tf(x, y, yaw)
+                        cmds_b.append(self._spawn(self.bps_b, vid, tf, vid in self._spawn_failed_b))
+                    elif moved or vid in self._lifted_b:
+                        self._lifted_b.discard(vid)
+                        tf = tf or make_tf(x, y, yaw)
+                        cmds_b.append(carla.command.ApplyTransform(actor_b, tf))
+                elif actor_b is not None:
+                    cmds_b.append(carla.command.DestroyActor(actor_b)); del self._b[vid]
+                    self._lifted_b.discard(vid)
+
+            futures = [
+                self._pool.submit(self._apply_batch, self.client_a, cmds_a, spawned_a, self._a,
+                                  self._spawn_failed_a, self._lifted_a),
+                self._pool.submit(self._apply_batch, self.client_b, cmds_b, spawned_b, self._b,
+                                  self._spawn_failed_b, self._lifted_b),
+            ]
+
+            # Пока миры CARLA применяют команды и делают tick, SUMO считает следующий шаг
+            traci.simulationStep()
+            for f in futures:
+                f.result()
 
     def close(self):
-        for vid in list(self.actors.keys()):
+        # Дожидаемся пакетов последнего шага, иначе актеры, созданные ими, не попадут в реестр и не удалятся
+        self._pool.shutdown(wait=True)
+        for vid in list(self._a.keys() | self._b.keys()):
             self._destroy_vehicle_everywhere(vid)
+        # Сервер CARLA может быть уже недоступен, закрытие при этом не должно падать
+        try:
+            self._apply_batch(self.client_a, self._take_pending_destroy(self._pending_destroy_a), {}, self._a,
+                              self._spawn_failed_a, self._lifted_a, False)
+        except Exception:
+            pass
         try:
-            self.world_a.apply_settings(self._orig_settings_a)
+            self._apply_batch(self.client_b, self._take_pending_destroy(self._pending_destroy_b), {}, self._b,
+                              self._spawn_failed_b, self._lifted_b, False)
         except Exception:
             pass
         try:
-            self.world_b.apply_settings(self._orig_settings_b)
+            self._apply_sync(self.world_a, self._settings_a, *self._orig_sync_a)
         except Exception:
             pass
         try:
-            traci.close(False)
+            self._apply_sync(self.world_b, self._settings_b, *self._orig_sync_b)
+        except Exception:
+            pass
+        try:
+            # У traci не ждем завершения процесса sumo-gui, у libsumo отдельного процесса нет
+            if LIBSUMO:
+                traci.close()
+            else:
+                traci.close(False)
         except Exception:
             pass
 
@@ -0,0 +1,80 @@
+from typing import NamedTuple, Tuple
+
+# Numba необязателен: если он установлен, пакетный перевод координат компилируется, иначе считается через NumPy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# -------------------- Coord transform --------------------
+# Блок нужен для трансформации координат net.xml и xodr
+# В файле net.xml есть тег location, в котором указаны границы карты и их смещение
+# Из этого можно в реальном времени перевести координаты машины в SUMO в координаты Carla карты
+# Используется и мостом (bridge.py), и debug.py
+
+class Boundary(NamedTuple):
+    minX: float
+    minY: float
+    maxX: float
+    maxY: float
+
+# net.xml читается один раз при запуске, поэтому ElementTree импортируется только здесь
+# Тег location идет в начале файла, поэтому разбор останавливается на нем, а не строит дерево всей сети
+def read_boundaries_from_net(net_file: str):
+    import xml.etree.ElementTree as ET
+
+    location = None
+    with open(net_file, "rb") as f:
+        for _, el in ET.iterparse(f, events=("start",)):
+            if el.tag == "location":
+                location = el
+                break
+    if location is None:
+        raise ValueError("No <location> found in net.xml")
+
+    conv_vals = list(map(float, location.get("convBoundary").split(",")))
+    orig_vals = list(map(float, location.get("origBoundary").split(",")))
+
+    conv = Boundary(*conv_vals)
+    orig = Boundary(*orig_vals)
+    return conv, orig
+
+# Преобразование линейное, поэтому масштаб и смещение считаются один раз, а не на каждую машину
+# Возвращает (sx, ox, sy, oy): x = ox + convX * sx, y = oy + convY * sy
+def affine_params(conv: Boundary, orig: Boundary) -> Tuple[float, float, float, float]:
+    conv_min_x, conv_min_y, conv_max_x, conv_max_y = conv
+    orig_min_x, orig_min_y, orig_max_x, orig_max_y = orig
+
+    sx = (orig_max_x - orig_min_x) / (conv_max_x - conv_min_x)
+    sy = (orig_max_y - orig_min_y) / (conv_max_y - conv_min_y)
+    ox = orig_min_x - conv_min_x * sx
+    oy = orig_min_y - conv_min_y * sy
+    return sx, ox, sy, oy
+
+# transform принимает как отдельные координаты, так и массивы NumPy координат всех машин
+def create_coordinate_transformer(conv: Boundary, orig: Boundary):
+    sx, ox, sy, oy = affine_params(conv, orig)
+
+    def transform(convX: float, convY: float):
+        return ox + convX * sx, oy + convY * sy
+    return transform
+
+
+# Пакетный перевод SUMO -> CARLA для всех машин сразу: net.xml в xodr, инверсия оси Y и поворот yaw на 90 градусов
+# Результат пишется в out[i] = (x, y, yaw)
+def _sumo_to_carla_numpy(xs, ys, ang, sx, ox, sy, oy, out):
+    out[:, 0] = ox + xs * sx
+    out[:, 1] = -(oy + ys * sy)
+    out[:, 2] = ang - 90.0
+
+def _sumo_to_carla_loop(xs, ys, ang, sx, ox, sy, oy, out):
+    for i in range(xs.size):
+        out[i, 0] = ox + xs[i] * sx
+        out[i, 1] = -(oy + ys[i] * sy)
+        out[i, 2] = ang[i] - 90.0
+
+if njit is not None:
+    sumo_to_carla_batch = njit(cache=True, fastmath=True)(_sumo_to_carla_loop)
+else:
+    sumo_to_carla_batch = _sumo_to_carla_numpy
@@ -1,35 +1,11 @@
-import traci
+import numpy as np
+import traci.constants as tc
 import sys
-import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+from coords import create_coordinate_transformer, read_boundaries_from_net
+from traci_backend import traci
 
-@dataclass
-class Boundary:
-    minX: float
-    minY: float
-    maxX: float
-    maxY: float
-
-def create_coordinate_transformer(conv: Boundary, orig: Boundary):
-    def transform(convX: float, convY: float):
-        x = orig.minX + ((convX - conv.minX) / (conv.maxX - conv.minX)) * (orig.maxX - orig.minX)
-        y = orig.minY + ((convY - conv.minY) / (conv.maxY - conv.minY)) * (orig.maxY - orig.minY)
-        return x, y
-    return transform
-
-def read_boundaries_from_net(net_file: str):
-    tree = ET.parse(net_file)
-    root = tree.getroot()
-    location = root.find("location")
-    if location is None:
-        raise ValueError("No <location> found in net.xml")
-
-    conv_vals = list(map(float, location.get("convBoundary").split(",")))
-    orig_vals = list(map(float, location.get("origBoundary").split(",")))
-
-    conv = Boundary(*conv_vals)
-    orig = Boundary(*orig_vals)
-    return conv, orig
+# Строка вывода одной машины, все строки шага пишутся в stdout одним вызовом
+LINE_FMT = "%s: SUMO=(%.2f,%.2f)  XODR=(%.2f,%.2f)\n"
 
 def main(cfg_path, net_path, step_length=0.05):
     conv, orig = read_boundaries_from_net(net_path)
@@ -42,17 +18,33 @@ def main(cfg_path, net_path, step_length=0.05):
         "--quit-on-end"
     ])
     print("[debug] SUMO started")
+    traci.simulation.subscribe((tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS))
     print(f"[debug] convBoundary={conv}")
     print(f"[debug] origBoundary={orig}")
 
     try:
         while True:
             traci.simulationStep()
-            ids = traci.vehicle.getIDList()
-            for vid in ids:
-                xs, ys = traci.vehicle.getPosition(vid)
-                xo, yo = transform(xs, ys)
-                print(f"{vid}: SUMO=({xs:.2f},{ys:.2f})  XODR=({xo:.2f},{yo:.2f})")
+            res = traci.simulation.getSubscriptionResults()
+            arrived = res[tc.VAR_ARRIVED_VEHICLES_IDS]
+            for vid in res[tc.VAR_DEPARTED_VEHICLES_IDS]:
+                if vid not in arrived:
+                    traci.vehicle.subscribe(vid, (tc.VAR_POSITION,))
+
+            results = traci.vehicle.getAllSubscriptionResults()
+            pos = np.fromiter(
+                (v for sub in results.values() for v in sub[tc.VAR_POSITION]),
+                dtype=np.float64, count=2 * len(results)
+            ).reshape(-1, 2)
+            # У телепортирующихся машин вместо позиции INVALID_DOUBLE_VALUE, их не выводим
+            valid = pos[:, 0] != tc.INVALID_DOUBLE_VALUE
+            vids = [vid for vid, ok in zip(results, valid.tolist()) if ok]
+            pos = pos[valid]
+            xo, yo = transform(pos[:, 0], pos[:, 1])
+            sys.stdout.write("".join(
+                LINE_FMT % (vid, xs, ys, x, y)
+                for vid, (xs, ys), x, y in zip(vids, pos.tolist(), xo.tolist(), yo.tolist())
+            ))
     except KeyboardInterrupt:
         print("[debug] stopped by user")
     finally:
@@ -0,0 +1,13 @@
+import os
+
+# libsumo запускает SUMO внутри процесса без обмена по TCP, API тот же, что у traci.
+# Включается только через BRIDGE_LIBSUMO=1: у pip-сборок libsumo нет sumo-gui
+LIBSUMO = False
+if os.environ.get("BRIDGE_LIBSUMO") == "1":
+    try:
+        import libsumo as traci
+        LIBSUMO = True
+    except ImportError:
+        pass
+if not LIBSUMO:
+    import traci